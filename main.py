@@ -2,65 +2,177 @@
 
 import streamlit as st
 import pandas as pd
+import pyarrow as pa
 import requests
-import csv
+import hashlib
 import json
+import os
 import re
+import tempfile
+import threading
 import time
-from typing import List, Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Iterator, Tuple
 from datetime import datetime
+from pathlib import Path
+from pyarrow import csv as arrow_csv
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+PAGE_LIMIT = 1000
+PAGE_WINDOW = 4  # pages requested concurrently once the first page comes back full
+WRITE_BUFFER_SIZE = 1 << 20  # batch small csv writes into ~1 MiB syscalls
+CSV_BATCH_ROWS = 1000  # rows converted to an Arrow record batch at a time
+RATE_LIMIT_RPS = 10  # Helius free-tier request rate
+CACHE_TTL = 3600  # seconds a wallet's assets are reused across Streamlit reruns
+CACHE_DIR = Path(".cache")  # wallet listings kept across runs for CACHE_TTL, keyed by request hash
+MIN_YEAR, MAX_YEAR = 1990, 2025
+KEY_CLEAN_PATTERN = re.compile(r'[^\w\s-]')
+# Columns every flattened NFT has, in export order; trait_* and metadata_* columns follow, sorted.
+FIXED_FIELDS = [
+    'mint_address', 'owner', 'frozen', 'delegated',
+    'name', 'symbol', 'description', 'image', 'animation_url', 'external_url',
+    'collection_address', 'royalty_percent', 'royalty_locked',
+    'supply_print_max_supply', 'supply_print_current_supply', 'supply_edition_nonce',
+]
+KNOWN_METADATA_KEYS = ('name', 'symbol', 'description', 'image', 'animation_url', 'external_url', 'attributes')
+
+def clean_field_name(name: Any) -> str:
+    return KEY_CLEAN_PATTERN.sub('', str(name)).strip().replace(' ', '_')
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Reserve the token even when short, so concurrent callers queue up behind each other.
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+class CacheMissError(LookupError):
+    pass
+
+# Shared by every extractor so concurrent page threads draw from one request budget.
+rate_limiter = TokenBucket(RATE_LIMIT_RPS)
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def fetch_owner_assets(_extractor: "NFTMetadataExtractor", wallet_address: str, cache_mode: str) -> List[Dict[str, Any]]:
+    # Keyed on the wallet and cache mode; the leading underscore keeps Streamlit from hashing the extractor.
+    return _extractor.fetch_assets()
 
 class NFTMetadataExtractor:
-    def __init__(self, api_key: str, wallet_address: str):
+    def __init__(self, api_key: str, wallet_address: str, cache_mode: str = "Enabled"):
         self.api_key = api_key
         self.wallet_address = wallet_address
+        self.cache_mode = cache_mode  # "Enabled", "Replay" (cache only), "Refresh" (overwrite) or "Disabled"
         self.base_url = f"https://mainnet.helius-rpc.com/?api-key={self.api_key}"
+        self.session = requests.Session()
+        self.session.headers.update({"Content-Type": "application/json"})
+        retry = Retry(total=5, backoff_factor=0.3, status_forcelist=[429, 502, 503, 504],
+                      allowed_methods=frozenset({"POST"}))
+        adapter = HTTPAdapter(pool_maxsize=PAGE_WINDOW, max_retries=retry)
+        self.session.mount("https://", adapter)
 
-    def get_assets_by_owner(self) -> List[str]:
-        headers = {"Content-Type": "application/json"}
+    def get_assets_page(self, page: int) -> List[Dict[str, Any]]:
         payload = {
             "jsonrpc": "2.0",
             "id": "1",
             "method": "getAssetsByOwner",
             "params": {
                 "ownerAddress": self.wallet_address,
-                "page": 1,
-                "limit": 1000
+                "page": page,
+                "limit": PAGE_LIMIT
             }
         }
+        rate_limiter.acquire()
+        response = self.session.post(self.base_url, json=payload)
+        response.raise_for_status()
+        data = response.json()
+        return data.get('result', {}).get('items', [])
+
+    def cache_path(self, key: str) -> Path:
+        return CACHE_DIR / f"{hashlib.sha256(key.encode('utf-8')).hexdigest()}.json"
+
+    def cache_get(self, key: str, max_age: float = None):
+        path = self.cache_path(key)
         try:
-            response = requests.post(self.base_url, headers=headers, json=payload)
-            response.raise_for_status()
-            data = response.json()
-            return [item['id'] for item in data.get('result', {}).get('items', [])]
-        except requests.exceptions.RequestException as e:
-            st.error(f"Error fetching asset IDs: {e}")
-            return []
+            if max_age is not None and time.time() - path.stat().st_mtime > max_age:
+                return None
+            return json.loads(path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            # Missing or unreadable entries are misses; the next fetch overwrites them.
+            return None
 
-    def get_asset_by_id(self, asset_id: str) -> Dict[str, Any]:
-        headers = {"Content-Type": "application/json"}
-        payload = {
-            "jsonrpc": "2.0",
-            "id": "1",
-            "method": "getAsset",
-            "params": {
-                "id": asset_id
-            }
-        }
+    def cache_put(self, key: str, data: Any):
+        CACHE_DIR.mkdir(exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
         try:
-            response = requests.post(self.base_url, headers=headers, json=payload)
-            response.raise_for_status()
-            return response.json().get("result", {})
-        except requests.exceptions.RequestException as e:
-            st.error(f"Error fetching asset: {e}")
-            return {}
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            # Readers see either the old entry or the complete new one, never a partial write.
+            os.replace(tmp_path, self.cache_path(key))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def fetch_assets(self) -> List[Dict[str, Any]]:
+        # The whole listing is one entry so a result never mixes stale and fresh pages.
+        cache_key = f"{self.wallet_address}|getAssetsByOwner|{PAGE_LIMIT}"
+        if self.cache_mode in ("Enabled", "Replay"):
+            cached = self.cache_get(cache_key, max_age=None if self.cache_mode == "Replay" else CACHE_TTL)
+            if cached is not None:
+                return cached
+            if self.cache_mode == "Replay":
+                raise CacheMissError("No cached assets for this wallet (replay mode)")
+        assets = self.fetch_all_pages()
+        if self.cache_mode in ("Enabled", "Refresh"):
+            self.cache_put(cache_key, assets)
+        return assets
+
+    def fetch_all_pages(self) -> List[Dict[str, Any]]:
+        items = self.get_assets_page(1)
+        assets = list(items)
+        next_page = 2
+        with ThreadPoolExecutor(max_workers=PAGE_WINDOW) as executor:
+            # Pages are independent, so fetch them a window at a time and stop at the first short page.
+            while len(items) == PAGE_LIMIT:
+                pages = range(next_page, next_page + PAGE_WINDOW)
+                for items in list(executor.map(self.get_assets_page, pages)):
+                    assets.extend(items)
+                    if len(items) < PAGE_LIMIT:
+                        break
+                next_page += PAGE_WINDOW
+        # Parallel pages can overlap if holdings change mid-fetch; keep one entry per mint.
+        return list({asset.get('id'): asset for asset in assets}.values())
+
+    def get_assets_by_owner(self) -> List[Dict[str, Any]]:
+        try:
+            if self.cache_mode in ("Refresh", "Disabled"):
+                if self.cache_mode == "Refresh":
+                    fetch_owner_assets.clear()
+                return self.fetch_assets()
+            return fetch_owner_assets(self, self.wallet_address, self.cache_mode)
+        except (requests.exceptions.RequestException, CacheMissError) as e:
+            st.error(f"Error fetching assets: {e}")
+            return []
 
     def filter_nfts_by_year(self, nfts: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         filtered_nfts = []
-        year_pattern = re.compile(r'^(199[0-9]|20[01][0-9]|202[0-5])')
         for nft in nfts:
             name = nft.get('content', {}).get('metadata', {}).get('name') or nft.get('content', {}).get('name') or nft.get('name', '')
-            if name and year_pattern.match(str(name)):
+            # isascii() keeps Unicode digits like '²' (which int() rejects) out, matching [0-9].
+            prefix = str(name)[:4]
+            if prefix.isascii() and prefix.isdigit() and MIN_YEAR <= int(prefix) <= MAX_YEAR:
                 filtered_nfts.append(nft)
         return filtered_nfts
 
@@ -78,14 +190,6 @@ class NFTMetadataExtractor:
         flattened['image'] = metadata.get('image', '')
         flattened['animation_url'] = metadata.get('animation_url', '')
         flattened['external_url'] = metadata.get('external_url', '')
-        attributes = metadata.get('attributes', [])
-        if isinstance(attributes, list):
-            for i, attr in enumerate(attributes):
-                if isinstance(attr, dict):
-                    trait_type = attr.get('trait_type', f'attribute_{i}')
-                    value = attr.get('value', '')
-                    clean_trait = re.sub(r'[^\w\s-]', '', str(trait_type)).strip().replace(' ', '_')
-                    flattened[f'trait_{clean_trait}'] = value
         grouping = nft.get('grouping', [])
         for group in grouping:
             if group.get('group_key') == 'collection':
@@ -98,67 +202,101 @@ class NFTMetadataExtractor:
         flattened['supply_print_max_supply'] = supply.get('print_max_supply', 0)
         flattened['supply_print_current_supply'] = supply.get('print_current_supply', 0)
         flattened['supply_edition_nonce'] = supply.get('edition_nonce', '')
-        for key, value in metadata.items():
-            if key not in ['name', 'symbol', 'description', 'image', 'animation_url', 'external_url', 'attributes']:
-                clean_key = re.sub(r'[^\w\s-]', '', str(key)).strip().replace(' ', '_')
-                flattened[f'metadata_{clean_key}'] = json.dumps(value) if isinstance(value, (dict, list)) else str(value)
+        for key, value in self.iter_dynamic_fields(metadata):
+            if key.startswith('metadata_'):
+                value = json.dumps(value) if isinstance(value, (dict, list)) else str(value)
+            flattened[key] = value
         return flattened
 
+    def iter_dynamic_fields(self, metadata: Dict[str, Any]) -> Iterator[Tuple[str, Any]]:
+        # Sole source of the trait_*/metadata_* columns, shared by flatten_metadata and the header pre-pass.
+        attributes = metadata.get('attributes', [])
+        if isinstance(attributes, list):
+            for i, attr in enumerate(attributes):
+                if isinstance(attr, dict):
+                    trait_type = attr.get('trait_type', f'attribute_{i}')
+                    yield f'trait_{clean_field_name(trait_type)}', attr.get('value', '')
+        for key, value in metadata.items():
+            if key not in KNOWN_METADATA_KEYS:
+                yield f'metadata_{clean_field_name(key)}', value
+
+    def dynamic_fieldnames(self, nft: Dict[str, Any]) -> List[str]:
+        metadata = nft.get('content', {}).get('metadata', {})
+        return [key for key, _ in self.iter_dynamic_fields(metadata)]
+
     def export_to_csv(self, nfts: List[Dict[str, Any]], filename: str = None):
         if not nfts:
             st.warning("No NFTs to export")
-            return None
+            return None, None
         if filename is None:
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             filename = f"nft_metadata_{timestamp}.csv"
-        flattened_nfts = []
-        all_fields = set()
+        # Only the trait/metadata key names need a pre-pass; each row is flattened once while writing.
+        dynamic_fields = set()
         for nft in nfts:
-            flattened = self.flatten_metadata(nft)
-            flattened_nfts.append(flattened)
-            all_fields.update(flattened.keys())
-        fieldnames = sorted(all_fields)
-        with open(filename, 'w', newline='', encoding='utf-8') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-            for nft in flattened_nfts:
-                row = {field: nft.get(field, '') for field in fieldnames}
-                writer.writerow(row)
-        return filename
+            dynamic_fields.update(self.dynamic_fieldnames(nft))
+        fieldnames = FIXED_FIELDS + sorted(dynamic_fields)
+        # Every column is written as text; Arrow fills keys missing from a row with empty cells.
+        schema = pa.schema([(field, pa.string()) for field in fieldnames])
+        batches = []
+        with pa.output_stream(filename, buffer_size=WRITE_BUFFER_SIZE) as sink, \
+                arrow_csv.CSVWriter(sink, schema) as writer:
+            for start in range(0, len(nfts), CSV_BATCH_ROWS):
+                rows = [
+                    {key: None if value is None else str(value) for key, value in self.flatten_metadata(nft).items()}
+                    for nft in nfts[start:start + CSV_BATCH_ROWS]
+                ]
+                batch = pa.RecordBatch.from_pylist(rows, schema=schema)
+                writer.write_batch(batch)
+                batches.append(batch)
+        # The written batches double as the preview table, so the CSV is never parsed back.
+        return filename, pa.Table.from_batches(batches, schema=schema)
+
+def preview_frame(table: pa.Table) -> pd.DataFrame:
+    # The export table is all text; recover the types pd.read_csv used to infer so numbers sort numerically.
+    df = table.to_pandas()
+    df = df.mask(df.eq(''))
+    for column in df.columns:
+        values = df[column]
+        if values.isin(['True', 'False']).all():
+            df[column] = values.eq('True')
+            continue
+        try:
+            df[column] = pd.to_numeric(values)
+        except (ValueError, TypeError):
+            pass
+    return df
 
 def main():
     st.title("NFT Metadata Extractor for Solana Wallet")
     st.markdown("Fetch and export NFTs from your wallet by year (1990-2025).")
     api_key = st.text_input("Helius API Key", type="password")
     wallet_address = st.text_input("Solana Wallet Address")
+    cache_mode = st.radio("Cache mode", ["Enabled", "Replay", "Refresh", "Disabled"], horizontal=True,
+                          help="Enabled reuses responses for up to an hour. Replay serves the on-disk cache only, "
+                               "without network calls. Refresh refetches and overwrites the cache.")
     if st.button("Fetch NFTs"):
         if not api_key or not wallet_address:
             st.error("Please provide both API Key and Wallet Address.")
             return
-        extractor = NFTMetadataExtractor(api_key, wallet_address)
-        asset_ids = extractor.get_assets_by_owner()
-        if not asset_ids:
+        extractor = NFTMetadataExtractor(api_key, wallet_address, cache_mode)
+        all_nfts = extractor.get_assets_by_owner()
+        if not all_nfts:
             st.warning("No assets found or an error occurred.")
             return
-        all_nfts = []
-        for asset_id in asset_ids:
-            asset = extractor.get_asset_by_id(asset_id)
-            if asset:
-                all_nfts.append(asset)
-            time.sleep(0.25)  # Add delay to prevent 429 errors
         st.success(f"Fetched {len(all_nfts)} assets. Filtering by year 1990-2025...")
         filtered_nfts = extractor.filter_nfts_by_year(all_nfts)
         if not filtered_nfts:
             st.warning("No NFTs found with names starting with years 1990-2025.")
             return
         st.success(f"{len(filtered_nfts)} NFTs matched.")
-        filename = extractor.export_to_csv(filtered_nfts)
+        filename, table = extractor.export_to_csv(filtered_nfts)
         if filename:
             st.success(f"Export complete: {filename}")
-            df = pd.read_csv(filename)
-            st.dataframe(df)
-            with open(filename, "rb") as f:
-                st.download_button("Download CSV", data=f, file_name=filename, mime="text/csv")
+            st.dataframe(preview_frame(table))
+            # A callable defers reading the file until the button is clicked, off the script thread.
+            st.download_button("Download CSV", data=lambda: Path(filename).read_bytes(),
+                               file_name=filename, mime="text/csv")
 
 if __name__ == "__main__":
     main()